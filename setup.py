@@ -8,6 +8,7 @@ setup(
     py_modules=["spacesaver"],
     install_requires=[
         "matplotlib",
+        "numpy",
     ],
     entry_points={
         "console_scripts": [
@@ -4,13 +4,21 @@ This module provides a portable way to analyze directory sizes with a GUI.
 """
 
 import os
+import argparse
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
 import matplotlib.pyplot as plt
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import random
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
 
+_SIZE_UNITS = ("", "K", "M", "G", "T", "P", "E", "Z", "Y")
+_SIZE_FACTORS = tuple(1024 ** i for i in range(len(_SIZE_UNITS)))
+
+
 def get_size_format(b, factor=1024, suffix="B"):
     """
     Scale bytes to its proper byte format
@@ -18,55 +26,343 @@ def get_size_format(b, factor=1024, suffix="B"):
         1253656 => '1.20MB'
         1253656678 => '1.17GB'
     """
-    for unit in ["", "K", "M", "G", "T", "P", "E", "Z"]:
-        if b < factor:
-            return f"{b:.2f}{unit}{suffix}"
-        b /= factor
-    return f"{b:.2f}Y{suffix}"
+    if b < factor:
+        return f"{b:.2f}{suffix}"
+    if factor == 1024:
+        # each 1024x step is 10 more bits, so the unit follows from the bit length
+        idx = (int(b).bit_length() - 1) // 10
+        if idx > 8:
+            idx = 8
+        return f"{b / _SIZE_FACTORS[idx]:.2f}{_SIZE_UNITS[idx]}{suffix}"
+    idx = 1
+    while idx < 8 and b >= factor ** (idx + 1):
+        idx += 1
+    return f"{b / factor ** idx:.2f}{_SIZE_UNITS[idx]}{suffix}"
+
+
+class DirectorySizeCache:
+    """
+    Persistent map of directory path -> (mtime_ns, file_bytes), where
+    file_bytes is the size of the non-directory entries directly inside it.
+    An entry is reused while the directory's mtime is unchanged, i.e. no
+    entry was added, removed or renamed since it was recorded. A file that
+    grows in place leaves that mtime alone, so scans that must see such
+    changes pass refresh=True and stat every file again.
+    """
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+            db_path = os.path.join(cache_home, "spacesaver", "sizes.db")
+        self.db_path = db_path
+        # only the subtrees that have been scanned are read from disk
+        self._loaded_roots = []
+        self._entries = {}
+        self._dirty = {}
+        self._deleted = set()
+        # directories visited since the last prune()
+        self._seen = set()
+        # whether get() has returned a saved total since `reused` was last cleared
+        self.reused = False
+
+    def load(self, roots):
+        """Read the saved entries for each of `roots` and the directories below them."""
+        roots = [root for root in roots
+                 if not any(_is_within(root, loaded) for loaded in self._loaded_roots)]
+        if not roots:
+            return
+        self._loaded_roots.extend(roots)
+        try:
+            with closing(sqlite3.connect(self.db_path)) as conn:
+                for root in roots:
+                    rows = conn.execute(
+                        "SELECT path, mtime_ns, size FROM sizes"
+                        " WHERE path = ? OR (path >= ? AND path < ?)",
+                        (os.fsencode(root),) + _subtree_range(root),
+                    )
+                    for path, mtime_ns, size in rows:
+                        self._entries.setdefault(os.fsdecode(path), (mtime_ns, size))
+        except sqlite3.OperationalError:
+            # missing, locked or not yet created database: start empty
+            pass
+        except sqlite3.DatabaseError as e:
+            print(f"Size cache {self.db_path} is corrupt, rebuilding it: {e}")
+            self._discard_database()
+
+    def get(self, path, mtime_ns):
+        """Return the cached file bytes of `path`, or None if missing or stale."""
+        self._seen.add(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == mtime_ns:
+            self.reused = True
+            return entry[1]
+        return None
+
+    def set(self, path, mtime_ns, size):
+        # called from the scan threads; single dict/set operations are atomic
+        self._seen.add(path)
+        self._deleted.discard(path)
+        entry = (mtime_ns, size)
+        if self._entries.get(path) != entry:
+            self._entries[path] = self._dirty[path] = entry
+
+    def prune(self, roots):
+        """Forget the directories under `roots` that weren't visited since the last prune."""
+        for path in self._entries.keys() - self._seen:
+            if any(_is_within(path, root) for root in roots):
+                del self._entries[path]
+                self._dirty.pop(path, None)
+                self._deleted.add(path)
+        self._seen = set()
+
+    def flush(self):
+        """Write the changes since the last flush to the database in one transaction."""
+        for _ in range(2):
+            if not self._dirty and not self._deleted:
+                return
+            # paths are stored as bytes so undecodable file names round-trip
+            rows = [(os.fsencode(path), mtime_ns, size)
+                    for path, (mtime_ns, size) in self._dirty.items()]
+            deleted = [(os.fsencode(path),) for path in self._deleted]
+            self._dirty = {}
+            self._deleted = set()
+            try:
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+                with closing(sqlite3.connect(self.db_path)) as conn, conn:
+                    # WAL keeps the file consistent through a crash; NORMAL
+                    # sync may only lose the last writes, which costs a rescan
+                    conn.execute("PRAGMA journal_mode = WAL")
+                    conn.execute("PRAGMA synchronous = NORMAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS sizes ("
+                        "path BLOB PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL"
+                        ") WITHOUT ROWID"
+                    )
+                    conn.executemany("DELETE FROM sizes WHERE path = ?", deleted)
+                    conn.executemany("INSERT OR REPLACE INTO sizes VALUES (?, ?, ?)", rows)
+                return
+            except (OSError, sqlite3.OperationalError) as e:
+                print(f"Error saving size cache to {self.db_path}: {e}")
+                return
+            except sqlite3.DatabaseError as e:
+                print(f"Size cache {self.db_path} is corrupt, rebuilding it: {e}")
+                # retry once against a new file holding everything in memory
+                self._discard_database()
+
+    def _discard_database(self):
+        """Delete the database file; the next flush() rewrites every entry held in memory."""
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.db_path + suffix)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Error removing size cache {self.db_path + suffix}: {e}")
+        self._dirty = dict(self._entries)
+        self._deleted = set()
+
 
+def _is_within(path, root):
+    """Return True if `path` is `root` or lies below it."""
+    return path == root or path.startswith(os.path.join(root, ""))
 
-def get_directory_size(directory):
-    """Returns the `directory` size in bytes."""
+
+def _subtree_range(root):
+    """Return the (low, high) byte-string bounds of the paths below `root`."""
+    prefix = os.fsencode(os.path.join(root, ""))
+    return prefix, prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+# None until first used, then the process-wide DirectorySizeCache
+_dir_size_cache = None
+
+
+def _get_dir_size_cache():
+    """Return the shared DirectorySizeCache, loading it on first use."""
+    global _dir_size_cache
+    if _dir_size_cache is None:
+        _dir_size_cache = DirectorySizeCache()
+    return _dir_size_cache
+
+
+# Scanning through a directory descriptor lets every stat resolve a bare name
+# relative to it (fstatat-style) instead of walking the full path again
+_SCANDIR_FD = os.scandir in os.supports_fd
+
+
+def _scan_directory(path, cache, refresh):
+    """
+    Return a tuple (file_bytes, subdir_paths) for the entries directly in `path`.
+    Unless `refresh` is set, when `cache` still holds file_bytes for the
+    directory's current mtime only the subdirectories are listed and no file
+    is stat-ed.
+    """
     total = 0
+    subdirs = []
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY) if _SCANDIR_FD else None
     try:
-        for entry in os.scandir(directory):
-            if entry.is_file():
-                # if it's a file, use stat() function
-                total += entry.stat().st_size
-            elif entry.is_dir():
-                # if it's a directory, recursively call this function
-                try:
-                    total += get_directory_size(entry.path)
-                except (FileNotFoundError, PermissionError):
-                    pass
-    except NotADirectoryError:
-        # if `directory` isn't a directory, get the file size then
-        return os.path.getsize(directory)
-    except PermissionError:
-        # if for whatever reason we can't open the folder, return 0
-        return 0
-    except Exception as e:
-        print(f"Error accessing {directory}: {e}")
-        return 0
-    return total
+        # read the mtime before listing so changes made mid-scan invalidate it
+        mtime_ns = (os.stat(path) if fd is None else os.fstat(fd)).st_mtime_ns
+        cached = None if refresh else cache.get(path, mtime_ns)
+        with os.scandir(path if fd is None else fd) as it:
+            for entry in it:
+                # don't follow symlinks: it avoids an extra stat per link
+                # and keeps linked trees from being counted twice
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(os.path.join(path, entry.name))
+                elif cached is None:
+                    total += entry.stat(follow_symlinks=False).st_size
+    finally:
+        if fd is not None:
+            os.close(fd)
+    if cached is None:
+        cache.set(path, mtime_ns, total)
+    else:
+        total = cached
+    return total, subdirs
+
+
+# Traversal is syscall-bound, so oversubscribe the CPUs to overlap I/O latency
+MAX_WORKERS = (os.cpu_count() or 1) * 4
+# With a single CPU the pool's locking and hand-offs cost more than they
+# overlap, so everything is walked inline
+PARALLEL = (os.cpu_count() or 1) > 1
+# Only hand subdirectories to the pool when a directory fans out this much
+PARALLEL_THRESHOLD = 4
+
+
+def _scan_subtree(directories, cache, refresh):
+    """
+    Walk each of `directories` and return a tuple (file_bytes, deferred_dirs).
+    Directories with few subdirectories are walked inline; the children of
+    wider directories are returned in `deferred_dirs` to be scanned in parallel.
+    """
+    total = 0
+    deferred = []
+    stack = list(directories)
+    while stack:
+        current = stack.pop()
+        try:
+            size, subdirs = _scan_directory(current, cache, refresh)
+        except (FileNotFoundError, PermissionError):
+            continue
+        except Exception as e:
+            print(f"Error accessing {current}: {e}")
+            continue
+        total += size
+        if PARALLEL and len(subdirs) > PARALLEL_THRESHOLD:
+            deferred.extend(subdirs)
+        else:
+            stack.extend(subdirs)
+    return total, deferred
+
+
+def get_directory_size(directory, refresh=False):
+    """
+    Returns the `directory` size in bytes.
+    Directories whose mtime hasn't changed since an earlier scan reuse its
+    file totals; pass `refresh=True` to stat every file again, e.g. to catch
+    files that grew in place.
+    """
+    return get_directory_sizes([directory], refresh)[0]
+
+
+def get_directory_sizes(directories, refresh=False, on_done=None):
+    """
+    Returns the sizes in bytes of each of `directories`, measured together on
+    one thread pool. `refresh` is as for get_directory_size(). If given,
+    `on_done(i)` is called as soon as directories[i] has been fully measured.
+    Afterwards the shared cache's `reused` flag tells whether any total came
+    from the cache instead of being measured.
+    """
+    directories = [os.path.abspath(directory) for directory in directories]
+    cache = _get_dir_size_cache()
+    cache.load(directories)
+    cache.reused = False
+    sizes = [0] * len(directories)
+    # (index, path) of the subdirectories still to walk
+    subdirs = []
+    for i, directory in enumerate(directories):
+        try:
+            sizes[i], children = _scan_directory(directory, cache, refresh)
+        except NotADirectoryError:
+            # if `directory` isn't a directory, get the file size then
+            sizes[i] = os.path.getsize(directory)
+            continue
+        except PermissionError:
+            # if for whatever reason we can't open the folder, count it as 0
+            continue
+        except Exception as e:
+            print(f"Error accessing {directory}: {e}")
+            continue
+        subdirs.extend((i, path) for path in children)
+
+    # walk a narrow top level inline; the pool only starts when there is fan-out
+    deferred = []
+    if PARALLEL and len(subdirs) > PARALLEL_THRESHOLD:
+        deferred = subdirs
+    else:
+        for i, path in subdirs:
+            size, more = _scan_subtree([path], cache, refresh)
+            sizes[i] += size
+            deferred.extend((i, path) for path in more)
+
+    # tasks still running for each directory
+    outstanding = [0] * len(directories)
+    for i, _ in deferred:
+        outstanding[i] += 1
+    if on_done is not None:
+        for i, count in enumerate(outstanding):
+            if not count:
+                on_done(i)
+
+    if deferred:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            pending = {pool.submit(_scan_subtree, [path], cache, refresh): i
+                       for i, path in deferred}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    size, more = future.result()
+                    sizes[i] += size
+                    outstanding[i] += len(more) - 1
+                    for path in more:
+                        pending[pool.submit(_scan_subtree, [path], cache, refresh)] = i
+                    if not outstanding[i] and on_done is not None:
+                        on_done(i)
+
+    # directories the scan no longer found were deleted or renamed
+    cache.prune(directories)
+    cache.flush()
+    return sizes
 
 
 def generate_colors(n):
-    """Generate n distinct colors for the pie chart"""
-    colors = []
-    for i in range(n):
-        # Generate a random color with some transparency
-        color = (random.random(), random.random(), random.random(), 0.8)
-        colors.append(color)
+    """Generate n distinct colors for the pie chart, as an (n, 4) RGBA array"""
+    # Step hues by the golden ratio so adjacent slices stay far apart
+    hues = (np.arange(n) * 0.618033988749895) % 1.0
+    colors = plt.cm.hsv(hues)
+    # Add some transparency
+    colors[:, 3] = 0.8
     return colors
 
 
 class DirectoryAnalyzer:
-    def __init__(self, root=None):
+    # Largest number of directories plotted individually; the rest become "Other"
+    top_k = 50
+    # Smallest directories are grouped into "Other" while it stays under this
+    # percentage of the total; slices under it get no percentage label
+    min_pct = 3
+    
+    def __init__(self, root=None, use_cache=True):
         """
         Initialize the DirectoryAnalyzer.
         If root is None, a new Tk root window will be created.
+        If use_cache is False, every file is measured again instead of reusing
+        the sizes saved by earlier runs.
         """
+        self.use_cache = use_cache
         if root is None:
             self.root = tk.Tk()
             self.should_run_mainloop = True
@@ -92,6 +388,18 @@ class DirectoryAnalyzer:
                                    font=("Arial", 12), padx=10, pady=5)
         self.select_btn.pack(side=tk.LEFT, padx=5)
         
+        # Create refresh button, enabled once a directory has been analyzed
+        self.refresh_btn = tk.Button(self.button_frame, text="Refresh", 
+                                    command=self.refresh_analysis, state=tk.DISABLED,
+                                    font=("Arial", 12), padx=10, pady=5)
+        self.refresh_btn.pack(side=tk.LEFT, padx=5)
+        
+        # Create full rescan button, which measures every file again
+        self.rescan_btn = tk.Button(self.button_frame, text="Full rescan", 
+                                   command=self.full_rescan, state=tk.DISABLED,
+                                   font=("Arial", 12), padx=10, pady=5)
+        self.rescan_btn.pack(side=tk.LEFT, padx=5)
+        
         # Status label
         self.status_label = tk.Label(self.button_frame, text="Select a directory to analyze", 
                                     font=("Arial", 10), fg="#555555")
@@ -101,8 +409,17 @@ class DirectoryAnalyzer:
         self.plot_frame = tk.Frame(self.main_frame)
         self.plot_frame.pack(fill=tk.BOTH, expand=True)
         
-        # Initialize plot canvas as None
-        self.canvas = None
+        # Create the figure and canvas once; each analysis redraws into them
+        self.fig = plt.Figure(figsize=(8, 6), dpi=100)
+        self.ax = self.fig.add_subplot(111)
+        self.ax.set_axis_off()
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.plot_frame)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        # (folder_path, sizes, names) currently drawn on the canvas
+        self._plotted = None
+        
+        # Directory shown in the current plot
+        self.current_directory = None
         
     def analyze_directory(self):
         folder_path = filedialog.askdirectory(title="Select Directory to Analyze")
@@ -110,6 +427,25 @@ class DirectoryAnalyzer:
         if not folder_path:  # User canceled
             return
         
+        self.current_directory = folder_path
+        self.refresh_btn.config(state=tk.NORMAL)
+        self.rescan_btn.config(state=tk.NORMAL)
+        self.refresh_analysis()
+    
+    def full_rescan(self):
+        """Analyze the current directory again, measuring every file."""
+        self.refresh_analysis(refresh=True)
+    
+    def refresh_analysis(self, refresh=False):
+        """
+        Analyze the current directory again. Only directories whose mtime
+        changed since the last scan are re-read; the rest come from the size cache.
+        With `refresh` set (or the cache turned off) every file is stat-ed again,
+        which also catches files that grew in place.
+        """
+        folder_path = self.current_directory
+        refresh = refresh or not self.use_cache
+        
         self.status_label.config(text=f"Analyzing: {os.path.basename(folder_path)}")
         self.root.update()
         
@@ -128,20 +464,31 @@ class DirectoryAnalyzer:
             progress_label.pack(pady=20)
             progress_window.update()
             
-            # iterate over all the directories inside this path
-            for directory in os.listdir(folder_path):
-                full_path = os.path.join(folder_path, directory)
-                if os.path.isdir(full_path):
-                    # Update progress label
-                    progress_label.config(text=f"Scanning: {directory}")
-                    progress_window.update()
-                    
-                    # get the size of this directory (folder)
-                    directory_size = get_directory_size(full_path)
-                    if directory_size == 0:
-                        continue
-                    directory_sizes.append(directory_size)
-                    names.append(f"{directory}\n{get_size_format(directory_size)}")
+            # list the directories inside this path in one pass, closing the
+            # handle before the (long) size scans start
+            with os.scandir(folder_path) as it:
+                entries = [entry for entry in it if entry.is_dir(follow_symlinks=False)]
+            total_items = len(entries)
+            
+            scanned = 0
+            
+            def update_progress(i):
+                nonlocal scanned
+                scanned += 1
+                # Update progress label
+                progress_label.config(text=f"Scanned ({scanned}/{total_items}): {entries[i].name}")
+                progress_window.update()
+            
+            # get the size of every directory (folder) in one pass that shares
+            # a thread pool; sizes come back in listing order
+            entry_sizes = get_directory_sizes([entry.path for entry in entries], refresh,
+                                              on_done=update_progress)
+            
+            for entry, directory_size in zip(entries, entry_sizes):
+                if directory_size == 0:
+                    continue
+                directory_sizes.append(directory_size)
+                names.append(f"{entry.name}\n{get_size_format(directory_size)}")
             
             progress_window.destroy()
             
@@ -151,13 +498,13 @@ class DirectoryAnalyzer:
                 return
                 
             total_size = sum(directory_sizes)
-            self.status_label.config(text=f"Total size: {get_size_format(total_size)} - {os.path.basename(folder_path)}")
+            status = f"Total size: {get_size_format(total_size)} - {os.path.basename(folder_path)}"
+            if _get_dir_size_cache().reused:
+                # files that grew in place don't show up until a full rescan
+                status += " (cached; Full rescan to re-measure)"
+            self.status_label.config(text=status)
             
-            # Clear previous plot if exists
-            if self.canvas:
-                self.canvas.get_tk_widget().destroy()
-            
-            # Create new plot
+            # Draw the new plot
             self.plot_directory_sizes(directory_sizes, names, folder_path)
             
         except Exception as e:
@@ -165,22 +512,52 @@ class DirectoryAnalyzer:
             self.status_label.config(text=f"Error: {str(e)}")
     
     def plot_directory_sizes(self, sizes, names, folder_path):
+        # A refresh that found nothing new keeps the plot already on screen
+        plotted = (folder_path, list(sizes), list(names))
+        if plotted == self._plotted:
+            return
+        # forget the old plot first, so a drawing error can't leave it marked current
+        self._plotted = None
+        
+        sizes = np.asarray(sizes, dtype=np.int64)
+        total = int(sizes.sum())
+        order = np.arange(len(sizes))
+        if len(sizes) > self.top_k:
+            # Only the largest top_k need ordering: partition first, O(N + K log K)
+            order = np.argpartition(-sizes, self.top_k - 1)[:self.top_k]
         # Sort by size (largest first)
-        sorted_data = sorted(zip(sizes, names), reverse=True)
-        sizes = [s[0] for s in sorted_data]
-        names = [s[1] for s in sorted_data]
+        order = order[np.argsort(-sizes[order], kind="stable")]
+        # Fold the smallest slices into "Other" only while everything in it stays
+        # under min_pct of the total, so flat directories keep their names
+        tail = np.cumsum(sizes[order][::-1])[::-1]
+        folded = total - int(sizes[order].sum())
+        # float math: scaling the int64 sums by 100 would overflow past ~92 PB
+        keep = len(order) - int(np.count_nonzero((folded + tail) * 100.0 < total * self.min_pct))
+        # a lone slice is clearer under its own name than as "Other (1 items)"
+        if folded or keep < len(order) - 1:
+            order = order[:keep]
+        other_count = len(sizes) - len(order)
+        other_size = total - int(sizes[order].sum())
+        sizes = sizes[order]
+        names = [names[i] for i in order]
+        
+        # Everything past the top_k and the folded small slices form "Other"
+        if other_count:
+            sizes = np.append(sizes, other_size)
+            names.append(f"Other ({other_count} items)\n{get_size_format(other_size)}")
         
         # Generate colors
         colors = generate_colors(len(sizes))
         
-        # Create figure
-        fig = plt.Figure(figsize=(8, 6), dpi=100)
-        ax = fig.add_subplot(111)
+        # Clear the previous plot
+        ax = self.ax
+        ax.clear()
         
         wedges, texts, autotexts = ax.pie(
             sizes, 
             labels=names, 
-            autopct=lambda pct: f"{pct:.1f}%" if pct > 3 else "",
+            # slices under min_pct are too thin for a readable percentage
+            autopct=lambda pct: f"{pct:.1f}%" if pct >= self.min_pct else "",
             colors=colors,
             shadow=True,
             startangle=90
@@ -191,11 +568,8 @@ class DirectoryAnalyzer:
         plt.setp(autotexts, fontsize=9, weight="bold")
         
         ax.set_title(f"Directory Size Analysis: {os.path.basename(folder_path)}")
-        
-        # Create canvas
-        self.canvas = FigureCanvasTkAgg(fig, master=self.plot_frame)
-        self.canvas.draw()
-        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.canvas.draw_idle()
+        self._plotted = plotted
     
     def run(self):
         """Run the application main loop if needed"""
@@ -205,7 +579,11 @@ class DirectoryAnalyzer:
 
 def main():
     """Entry point for the application"""
-    app = DirectoryAnalyzer()
+    parser = argparse.ArgumentParser(description="Directory size analyzer")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="measure every file instead of reusing sizes saved by earlier runs")
+    args = parser.parse_args()
+    app = DirectoryAnalyzer(use_cache=not args.no_cache)
     app.run()
 
 